@@ -1,19 +1,21 @@
 import os
 import sys
-import json
+import csv
 import sqlite3
 import subprocess
 import signal
+import select
+import threading
 import time
+import orjson
 from flask import Flask, render_template, jsonify, request, redirect, url_for
-import pandas as pd
 
 # --- Correctly configure project paths ---
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 if ROOT_DIR not in sys.path:
     sys.path.insert(0, ROOT_DIR)
 
-from scripts.run_pipeline import setup_database
+from scripts.run_pipeline import setup_database, create_indexes
 
 # --- Configuration ---
 CONFIG_FILE = os.path.join(ROOT_DIR, 'config', 'chapter_map.csv')
@@ -21,12 +23,32 @@ DB_FILE = os.path.join(ROOT_DIR, 'data', 'question_bank.db')
 LOG_FILE = os.path.join(ROOT_DIR, 'process.log')
 # --- NEW: Lock file to track the running process ---
 PID_FILE = os.path.join(ROOT_DIR, 'process.pid')
+# Maximum number of log bytes sent to the dashboard in one '/status' poll.
+LOG_TAIL_BYTES = 64 * 1024
 
 # --- App Initialization ---
 app = Flask(__name__)
 
 # --- Global state for managing the background process ---
 process_handle = None
+# pidfd for the child (Linux 5.3+); becomes readable once the process exits.
+process_pidfd = None
+# The dev server is threaded: '/status' polls and the start/stop routes all touch the two globals
+# above, so they only do so while holding this lock. Re-entrant because the routes call
+# is_process_running() with it held.
+_PROCESS_LOCK = threading.RLock()
+
+# Bumped whenever a new run truncates the log. The log is rewritten in place, so a client's byte
+# offset alone can't tell a new run from the old one once the new log outgrows the old. Seeded from
+# the clock so tokens from before an app restart don't match.
+log_generation = int(time.time() * 1000)
+
+# --- Dashboard stats cache: the page polls every few seconds, so serve counts for a short TTL ---
+_STATS_TTL = 5.0
+_STATS_CACHE = {"t": 0.0, "v": None}
+
+# --- Parsed chapter_map.csv, keyed on the file's mtime ---
+_CHAPTERS_CACHE = {"mtime": None, "rows": []}
 
 # --- Custom Template Filter ---
 @app.template_filter('fromjson')
@@ -34,8 +56,8 @@ def fromjson_filter(value):
     if value is None:
         return []
     try:
-        return json.loads(value)
-    except (json.JSONDecodeError, TypeError):
+        return orjson.loads(value)
+    except (orjson.JSONDecodeError, TypeError):
         return []
 
 # --- Database Connection ---
@@ -43,18 +65,47 @@ def get_db_connection():
     """Establishes a connection to the SQLite database."""
     conn = sqlite3.connect(DB_FILE, timeout=15)
     conn.row_factory = sqlite3.Row
+    # WAL lets the dashboard read while the pipeline writes; the rest are per-connection tuning.
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    return conn
+
+def get_ro_connection():
+    """Opens a read-only connection for the dashboard's read paths; writers keep using get_db_connection."""
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, timeout=5)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
     return conn
 
 # --- Routes ---
+def load_chapters():
+    """Parses chapter_map.csv, re-reading it only when the file's mtime changes."""
+    mtime = os.stat(CONFIG_FILE).st_mtime
+    if mtime != _CHAPTERS_CACHE["mtime"]:
+        rows = []
+        with open(CONFIG_FILE, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                # Skip comment/placeholder rows that have no page range.
+                try:
+                    row['Start_Page'] = int(float(row['Start_Page']))
+                    row['End_Page'] = int(float(row['End_Page']))
+                except (TypeError, ValueError):
+                    continue
+                rows.append(row)
+        _CHAPTERS_CACHE["rows"] = rows
+        _CHAPTERS_CACHE["mtime"] = mtime
+    return _CHAPTERS_CACHE["rows"]
+
 @app.route('/')
 def dashboard():
     chapters = []
     try:
-        df = pd.read_csv(CONFIG_FILE)
-        df.dropna(subset=['Start_Page', 'End_Page'], inplace=True)
-        df['Start_Page'] = df['Start_Page'].astype(int)
-        df['End_Page'] = df['End_Page'].astype(int)
-        chapters = df.to_dict('records')
+        chapters = load_chapters()
     except Exception as e:
         print(f"Could not load chapters: {e}")
     
@@ -67,52 +118,106 @@ def get_stats():
     stats = get_current_stats()
     return jsonify(stats)
 
+# All four dashboard counts in a single statement / round-trip.
+STATS_QUERY = """
+SELECT
+    (SELECT COUNT(*) FROM parent_questions),
+    (SELECT COUNT(*) FROM variant_questions),
+    (SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'pending'),
+    (SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'approved')
+"""
+
+def invalidate_stats_cache():
+    _STATS_CACHE["t"] = 0.0
+
 def get_current_stats():
+    if _STATS_CACHE["v"] is not None and time.monotonic() - _STATS_CACHE["t"] < _STATS_TTL:
+        return dict(_STATS_CACHE["v"])
+
     stats = { "total_parents": 0, "total_variants": 0, "pending_validation": 0, "approved": 0 }
     if os.path.exists(DB_FILE):
         try:
-            conn = get_db_connection()
-            stats["total_parents"] = conn.execute('SELECT COUNT(*) FROM parent_questions').fetchone()[0]
-            stats["total_variants"] = conn.execute('SELECT COUNT(*) FROM variant_questions').fetchone()[0]
-            stats["pending_validation"] = conn.execute("SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'pending'").fetchone()[0]
-            stats["approved"] = conn.execute("SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'approved'").fetchone()[0]
+            conn = get_ro_connection()
+            row = conn.execute(STATS_QUERY).fetchone()
+            stats["total_parents"], stats["total_variants"], stats["pending_validation"], stats["approved"] = row
             conn.close()
         except Exception as e:
             print(f"Could not query DB stats: {e}")
-    return stats
+    _STATS_CACHE["v"] = stats
+    _STATS_CACHE["t"] = time.monotonic()
+    return dict(stats)
+
+def open_pidfd(pid):
+    """Returns a pidfd for the given PID, or None where pidfd_open is unavailable."""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+def close_pidfd():
+    """Closes the child's pidfd. Callers hold _PROCESS_LOCK so the fd is never closed twice."""
+    global process_pidfd
+    if process_pidfd is not None:
+        os.close(process_pidfd)
+        process_pidfd = None
+
+def is_process_running():
+    """Checks liveness via the pidfd when available, falling back to the PID file."""
+    global process_handle
+    with _PROCESS_LOCK:
+        if process_pidfd is None:
+            return os.path.exists(PID_FILE)
+
+        readable, _, _ = select.select([process_pidfd], [], [], 0)
+        if not readable:
+            return True
+
+        # The child has exited on its own: reap it and clear the stale lock.
+        close_pidfd()
+        if process_handle:
+            process_handle.wait()
+            process_handle = None
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
+        return False
 
 @app.route('/start-augmentation', methods=['POST'])
 def start_augmentation():
-    global process_handle
-    if process_handle and process_handle.poll() is None or os.path.exists(PID_FILE):
-        return jsonify({"status": "error", "message": "A process is already running."})
+    global process_handle, process_pidfd, log_generation
+    with _PROCESS_LOCK:
+        if is_process_running():
+            return jsonify({"status": "error", "message": "A process is already running."})
 
-    chapter_selection = request.form.get('chapter')
-    subject, chapter_name = chapter_selection.split('|', 1)
+        chapter_selection = request.form.get('chapter')
+        subject, chapter_name = chapter_selection.split('|', 1)
 
-    with open(LOG_FILE, 'w') as f:
-        f.write(f"Starting augmentation for: {subject} - {chapter_name}\n")
+        log_generation += 1
+        with open(LOG_FILE, 'w') as f:
+            f.write(f"Starting augmentation for: {subject} - {chapter_name}\n")
 
-    command = [sys.executable, '-m', 'scripts.run_pipeline', '--augment', subject, chapter_name]
-    log_handle = open(LOG_FILE, 'a')
-    process_handle = subprocess.Popen(command, stdout=log_handle, stderr=log_handle, text=True, preexec_fn=os.setsid)
+        command = [sys.executable, '-m', 'scripts.run_pipeline', '--augment', subject, chapter_name]
+        log_handle = open(LOG_FILE, 'a')
+        process_handle = subprocess.Popen(command, stdout=log_handle, stderr=log_handle, text=True, preexec_fn=os.setsid)
+        process_pidfd = open_pidfd(process_handle.pid)
     
-    # --- NEW: Create the PID file ---
-    with open(PID_FILE, 'w') as f:
-        f.write(str(os.getpgid(process_handle.pid)))
+        # --- NEW: Create the PID file ---
+        with open(PID_FILE, 'w') as f:
+            f.write(str(os.getpgid(process_handle.pid)))
     
-    return jsonify({"status": "success", "message": f"Started augmentation for {chapter_name}."})
+        return jsonify({"status": "success", "message": f"Started augmentation for {chapter_name}."})
 
 @app.route('/stop-process', methods=['POST'])
 def stop_process():
     global process_handle
-    if process_handle and process_handle.poll() is None:
-        os.killpg(os.getpgid(process_handle.pid), signal.SIGTERM)
-        process_handle.wait()
-        process_handle = None
-    # Also clean up the PID file if it exists, regardless of the handle
-    if os.path.exists(PID_FILE):
-        os.remove(PID_FILE)
+    with _PROCESS_LOCK:
+        if process_handle and process_handle.poll() is None:
+            os.killpg(os.getpgid(process_handle.pid), signal.SIGTERM)
+            process_handle.wait()
+            process_handle = None
+        close_pidfd()
+        # Also clean up the PID file if it exists, regardless of the handle
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
     with open(LOG_FILE, 'a') as f:
         f.write("\n\n--- PROCESS MANUALLY TERMINATED BY USER ---\n")
     return jsonify({"status": "success", "message": "Process terminated."})
@@ -120,15 +225,30 @@ def stop_process():
 
 @app.route('/status')
 def status():
-    # The running status is now determined by the existence of the PID file for robustness
-    is_running = os.path.exists(PID_FILE)
-    
+    is_running = is_process_running()
+    # The client sends back the offset it has read up to, so each poll only ships new bytes.
+    offset = request.args.get('offset', type=int)
+    generation = request.args.get('gen', type=int)
+
     log_content = "Log file not found."
+    reset = True
     if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r') as f:
-            log_content = f.read()
+        size = os.path.getsize(LOG_FILE)
+        # No (or a bogus negative) offset, or the log was rewritten by a new run: start over from the tail.
+        if offset is None or offset < 0 or offset > size or generation != log_generation:
+            offset = 0
+        else:
+            reset = False
+        start = max(offset, size - LOG_TAIL_BYTES)
+        reset = reset or start != offset
+        with open(LOG_FILE, 'rb') as f:
+            f.seek(start)
+            log_content = f.read(size - start).decode('utf-8', errors='replace')
+        offset = size
+    else:
+        offset = None
 
-    return jsonify({"running": is_running, "output": log_content})
+    return jsonify({"running": is_running, "output": log_content, "offset": offset, "gen": log_generation, "reset": reset})
     
 @app.route('/setup-database', methods=['POST'])
 def setup_db_route():
@@ -137,6 +257,7 @@ def setup_db_route():
         if os.path.exists(PID_FILE):
             stop_process()
         setup_database()
+        invalidate_stats_cache()
         return jsonify({"status": "success", "message": "Database has been successfully reset."})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
@@ -145,7 +266,7 @@ def setup_db_route():
 def validate():
     # This function should be a read-only operation and is safe.
     try:
-        conn = get_db_connection()
+        conn = get_ro_connection()
         variant = conn.execute("SELECT * FROM variant_questions WHERE validation_status = 'pending' LIMIT 1").fetchone()
         parent = None
         if variant:
@@ -167,6 +288,7 @@ def submit_validation():
             conn.execute("UPDATE variant_questions SET validation_status = ? WHERE id = ?", (action, question_id))
             conn.commit()
             conn.close()
+            invalidate_stats_cache()
             print(f"Validation for ID {question_id} successful.")
         except sqlite3.OperationalError as e:
             print(f"A database error occurred during validation: {e}")
@@ -178,6 +300,12 @@ def main():
     if not os.path.exists(DB_FILE):
         print("Database not found. Initializing a new one...")
         setup_database()
+    else:
+        # Databases created by older versions may be missing the newer indexes.
+        conn = get_db_connection()
+        create_indexes(conn.cursor())
+        conn.commit()
+        conn.close()
     
     # Clean up any stale PID file on startup
     if os.path.exists(PID_FILE):
@@ -16,6 +16,48 @@ DB_FILE = os.path.join(ROOT_DIR, 'data', 'question_bank.db')
 PID_FILE = os.path.join(ROOT_DIR, 'process.pid') # Path to the process lock file
 
 
+# How long to wait for the pipeline to exit after a signal, polled in small steps.
+STOP_TIMEOUT_SECONDS = 2.0
+STOP_POLL_INTERVAL = 0.1
+
+
+def process_group_alive(pgid):
+    """True while any member of the group is still running.
+
+    The pipeline is a child of the dashboard, not of this script, so after a signal it lingers as
+    a zombie until the dashboard reaps it. killpg(pgid, 0) still succeeds on zombies, so members
+    are checked in /proc and those in state 'Z' count as exited.
+    """
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return True  # no procfs; the signal check above is all we have
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # Fields after the parenthesised command name: state, ppid, pgrp, ...
+                state, _, pgrp = f.read().rsplit(')', 1)[1].split()[:3]
+        except (OSError, IndexError, ValueError):
+            continue
+        if int(pgrp) == pgid and state != 'Z':
+            return True
+    return False
+
+
+def wait_for_process_group_exit(pgid):
+    """Polls until the process group has exited. Returns False on timeout."""
+    deadline = time.monotonic() + STOP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if not process_group_alive(pgid):
+            return True
+        time.sleep(STOP_POLL_INTERVAL)
+    return False
+
+
 def stop_running_pipeline():
     """Checks for a PID file and stops the running pipeline if it exists."""
     if os.path.exists(PID_FILE):
@@ -27,8 +69,11 @@ def stop_running_pipeline():
             print(f"Stopping process group with PGID: {pgid}...")
             os.killpg(pgid, signal.SIGTERM)
             
-            # Wait a moment for the process to terminate
-            time.sleep(2)
+            # Return as soon as the process group is gone instead of always sleeping
+            if not wait_for_process_group_exit(pgid):
+                print("Process did not exit after SIGTERM; sending SIGKILL...")
+                os.killpg(pgid, signal.SIGKILL)
+                wait_for_process_group_exit(pgid)
             
             if os.path.exists(PID_FILE):
                 os.remove(PID_FILE) # Clean up if stop was slow
@@ -48,35 +93,47 @@ def stop_running_pipeline():
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
     conn = sqlite3.connect(DB_FILE, timeout=15)
+    # The same connection is handed on to the export, which reads rows by column name.
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
     return conn
 
-def approve_all_pending_questions():
-    """Updates all 'pending' questions to 'approved'."""
+def approve_all_pending_questions(conn=None):
+    """Updates all 'pending' questions to 'approved'. Uses `conn` if given, leaving it open."""
     print("Connecting to the database for approval...")
-    conn = get_db_connection()
+    owns_connection = conn is None
+    if owns_connection:
+        conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'pending'")
-    count = cursor.fetchone()[0]
+    try:
+        cursor.execute("SELECT COUNT(*) FROM variant_questions WHERE validation_status = 'pending'")
+        count = cursor.fetchone()[0]
 
-    if count == 0:
-        print("No pending questions found to approve.")
-        conn.close()
-        return 0
+        if count == 0:
+            print("No pending questions found to approve.")
+            return 0
 
-    print(f"Found {count} pending questions. Updating their status to 'approved'...")
-    
-    try:
+        print(f"Found {count} pending questions. Updating their status to 'approved'...")
+
+        # Take the write lock up front so a concurrent writer can't make the UPDATE fail part-way with SQLITE_BUSY.
+        cursor.execute("BEGIN IMMEDIATE")
         cursor.execute("UPDATE variant_questions SET validation_status = 'approved' WHERE validation_status = 'pending'")
-        conn.commit()
         updated_count = cursor.rowcount
+        conn.commit()
         print(f"Successfully approved {updated_count} questions.")
         return updated_count
     except sqlite3.Error as e:
+        conn.rollback()
         print(f"A database error occurred during approval: {e}")
         return 0
     finally:
-        conn.close()
+        if owns_connection:
+            conn.close()
 
 
 if __name__ == "__main__":
@@ -84,13 +141,18 @@ if __name__ == "__main__":
     
     was_running = stop_running_pipeline()
     
-    # Step 1: Run the auto-validation
-    approve_all_pending_questions()
-    
-    # Step 2: Run the LaTeX export
-    print("\n--------------------------------------------------\n")
-    print("Starting LaTeX export process for all approved questions...")
-    export_approved_questions()
+    # One connection serves both steps so the export reads from an already-warm page cache.
+    conn = get_db_connection()
+    try:
+        # Step 1: Run the auto-validation
+        approve_all_pending_questions(conn)
+        
+        # Step 2: Run the LaTeX export
+        print("\n--------------------------------------------------\n")
+        print("Starting LaTeX export process for all approved questions...")
+        export_approved_questions(conn)
+    finally:
+        conn.close()
 
     print("\n--- Script finished. ---")
     if was_running:
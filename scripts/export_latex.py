@@ -1,8 +1,10 @@
 import os
 import sqlite3
-import json
-import math
+import multiprocessing
+import itertools
+from collections import deque
 import re
+import orjson
 
 # --- Configuration ---
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -11,14 +13,26 @@ OUTPUT_DIR = os.path.join(ROOT_DIR, 'output')
 
 # --- Constants ---
 QUESTIONS_PER_FILE = 50
+# Leading option labels such as "A) " or "b. " that the model sometimes includes.
+OPTION_LABEL_RE = re.compile(r'^[A-Ea-e][\)\.]\s*')
+# Characters escaped by clean_text. '$', '_', '{' and '}' are deliberately left alone:
+# question text carries inline LaTeX math ($A_x$, ^{238}) that must reach pdflatex intact.
+LATEX_ESCAPE_TABLE = str.maketrans({'%': r'\%', '&': r'\&', '#': r'\#'})
 
 # ==============================================================================
 # === DATABASE CONNECTION ======================================================
 # ==============================================================================
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=15)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    # The export only reads; refuse writes on this connection.
+    conn.execute("PRAGMA query_only=1;")
     return conn
 
 # ==============================================================================
@@ -64,11 +78,8 @@ def clean_text(text):
     """A helper function to clean up common text issues for LaTeX."""
     if not text:
         return ""
-    # Replace special characters that can break LaTeX
-    text = text.replace('%', r'\%')
-    text = text.replace('&', r'\&')
-    text = text.replace('#', r'\#')
-    return text
+    # Replace special characters that can break LaTeX, in a single pass
+    return text.translate(LATEX_ESCAPE_TABLE)
 
 def format_question_as_latex(question_data):
     """Takes a database row and formats it into a professional LaTeX string."""
@@ -78,16 +89,16 @@ def format_question_as_latex(question_data):
     
     # Safely load options from the JSON string
     try:
-        options = json.loads(question_data['options']) if question_data['options'] else []
-    except json.JSONDecodeError:
+        options = orjson.loads(question_data['options']) if question_data['options'] else []
+    except orjson.JSONDecodeError:
         options = []
 
-    # Start with the question text
-    latex_string = f"\\item {question_text}\n"
+    # Start with the question text; pieces are collected in a list and joined once at the end
+    parts = [f"\\item {question_text}\n"]
     
     # Add the diagram if it exists, wrapped in a centered figure
     if question_data['diagram_latex'] and 'tikzpicture' in question_data['diagram_latex']:
-        latex_string += (
+        parts.append(
             "\\begin{center}\n"
             f"{question_data['diagram_latex']}\n"
             "\\end{center}\n"
@@ -95,35 +106,60 @@ def format_question_as_latex(question_data):
     
     # Add the multiple-choice options, cleaning them up
     if options:
-        latex_string += "\\begin{enumerate}[label=(\\alph*), itemsep=0.5em]\n"
+        parts.append("\\begin{enumerate}[label=(\\alph*), itemsep=0.5em]\n")
         for option in options:
             # Clean the option text and remove any leading "A) ", "B) ", etc.
             cleaned_option = clean_text(option)
-            cleaned_option = re.sub(r'^[A-Ea-e][\)\.]\s*', '', cleaned_option)
-            latex_string += f"    \\item {cleaned_option}\n"
-        latex_string += "\\end{enumerate}\n"
+            cleaned_option = OPTION_LABEL_RE.sub('', cleaned_option)
+            parts.append(f"    \\item {cleaned_option}\n")
+        parts.append("\\end{enumerate}\n")
         
     # Add a clear separator for the answer and explanation
-    latex_string += "\\vspace{0.5em}\n"
-    latex_string += f"\\textbf{{Answer:}} {question_data['correct_answer']}\\\\\n"
-    latex_string += f"\\textbf{{Explanation:}} {explanation}\n"
+    parts.append("\\vspace{0.5em}\n")
+    parts.append(f"\\textbf{{Answer:}} {question_data['correct_answer']}\\\\\n")
+    parts.append(f"\\textbf{{Explanation:}} {explanation}\n")
     
-    return latex_string
+    return "".join(parts)
 
-def export_approved_questions():
-    """Fetches approved questions and writes them to batched LaTeX files."""
+def write_batch_file(batch_number, question_batch):
+    """Writes one batch of questions to its own .tex file. Runs in a worker process."""
+    first_question_subject = question_batch[0]['subject'].replace(" ", "_").replace(":", "").replace("/", "_")
+    filename = f"{first_question_subject}_Approved_Batch_{batch_number}.tex"
+    filepath = os.path.join(OUTPUT_DIR, filename)
+    
+    print(f"Writing {len(question_batch)} questions to '{filepath}'...", flush=True)
+
+    # Build the whole document in memory and write it with a single call.
+    parts = [get_latex_preamble(f"Approved Questions: Batch {batch_number}")]
+    parts.extend(format_question_as_latex(question) for question in question_batch)
+    parts.append(get_latex_footer())
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write("".join(parts))
+    return filepath
+
+def export_approved_questions(conn=None):
+    """Fetches approved questions and writes them to batched LaTeX files.
+
+    If `conn` is given it is reused (and left open); otherwise a connection is opened here.
+    The connection must use sqlite3.Row as its row factory.
+    """
     
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    conn = get_db_connection()
+    owns_connection = conn is None
+    if owns_connection:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     print("Fetching approved questions from the database...")
     
     query = """
     SELECT 
-        vq.*,
-        pq.subject,
-        pq.chapter
+        vq.question_text,
+        vq.options,
+        vq.correct_answer,
+        vq.explanation,
+        vq.diagram_latex,
+        pq.subject
     FROM 
         variant_questions vq
     JOIN 
@@ -134,40 +170,45 @@ def export_approved_questions():
         pq.subject, pq.chapter, vq.id
     """
     
-    cursor.execute(query)
-    approved_questions = cursor.fetchall()
-    conn.close()
-    
-    if not approved_questions:
+    # Fetch one file's worth of rows at a time and hand each batch to a worker process,
+    # which formats it and writes its own .tex file.
+    batch_number = 0
+    total_questions = 0
+    try:
+        cursor.execute(query)
+        batches = iter(lambda: cursor.fetchmany(QUESTIONS_PER_FILE), [])
+        first_batch = next(batches, None)
+        second_batch = next(batches, None)
+
+        if second_batch is None:
+            # Zero or one batch: not worth forking a pool.
+            if first_batch is not None:
+                batch_number, total_questions = 1, len(first_batch)
+                write_batch_file(batch_number, [dict(row) for row in first_batch])
+        else:
+            processes = os.cpu_count() or 1
+            with multiprocessing.Pool(processes) as pool:
+                pending = deque()
+                for question_batch in itertools.chain((first_batch, second_batch), batches):
+                    batch_number += 1
+                    total_questions += len(question_batch)
+                    # Bound the batches in flight so rows keep streaming instead of piling up in the pool's queue.
+                    if len(pending) >= 2 * processes:
+                        pending.popleft().get()
+                    # sqlite3.Row does not pickle, so hand the workers plain dicts.
+                    pending.append(pool.apply_async(write_batch_file, (batch_number, [dict(row) for row in question_batch])))
+
+                for result in pending:
+                    result.get()
+    finally:
+        if owns_connection:
+            conn.close()
+
+    if batch_number == 0:
         print("No approved questions found to export.")
         return
 
-    print(f"Found {len(approved_questions)} approved questions. Preparing to write files...")
-
-    total_files = math.ceil(len(approved_questions) / QUESTIONS_PER_FILE)
-    
-    for file_index in range(total_files):
-        batch_number = file_index + 1
-        start_index = file_index * QUESTIONS_PER_FILE
-        end_index = start_index + QUESTIONS_PER_FILE
-        question_batch = approved_questions[start_index:end_index]
-        
-        if not question_batch:
-            continue
-            
-        # New, corrected line
-        first_question_subject = question_batch[0]['subject'].replace(" ", "_").replace(":", "").replace("/", "_")
-        filename = f"{first_question_subject}_Approved_Batch_{batch_number}.tex"
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        
-        print(f"Writing {len(question_batch)} questions to '{filepath}'...")
-
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(get_latex_preamble(f"Approved Questions: Batch {batch_number}"))
-            for question in question_batch:
-                f.write(format_question_as_latex(question))
-            f.write(get_latex_footer())
-            
+    print(f"Exported {total_questions} approved questions across {batch_number} files.")
     print("\nExport complete!")
     print(f"All .tex files have been saved in the '{OUTPUT_DIR}' directory.")
 
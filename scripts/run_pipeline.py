@@ -1,15 +1,19 @@
 import os
 import sys
-import json
 import time
 import re
 import argparse
 import pandas as pd
-import pdfplumber
+import pypdfium2 as pdfium
 import sqlite3
 import subprocess
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+import orjson
 
-from .utils import gemini_manager
+from .utils import gemini_manager, LLM_CACHE_SCHEMA
 
 # --- Configuration ---
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -17,6 +21,12 @@ RAW_PDF_DIR = os.path.join(ROOT_DIR, 'data', 'raw_jee_materials')
 DB_FILE = os.path.join(ROOT_DIR, 'data', 'question_bank.db')
 CONFIG_FILE = os.path.join(ROOT_DIR, 'config', 'chapter_map.csv')
 OUTPUT_DIR = os.path.join(ROOT_DIR, 'output')
+# Pages are extracted and dispatched to the API workers this many at a time.
+PAGE_BATCH_SIZE = 10
+
+def json_dumps(obj):
+    # orjson returns bytes; SQLite TEXT columns want str
+    return orjson.dumps(obj).decode('utf-8')
 
 
 # ==============================================================================
@@ -25,16 +35,64 @@ OUTPUT_DIR = os.path.join(ROOT_DIR, 'output')
 
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
-    # The PRAGMA command is REMOVED from here.
-    # It is now set permanently on the DB file during setup.
-    conn = sqlite3.connect(DB_FILE, timeout=15)
+    # isolation_level=None turns off the sqlite3 module's implicit BEGINs; writes that must be
+    # atomic go through write_transaction() instead.
+    conn = sqlite3.connect(DB_FILE, timeout=15, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    # journal_mode=WAL is persistent on the file (see setup_database) and a no-op here
+    # once set; the remaining pragmas are per-connection and must be applied every time.
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
     return conn
 
+# Insert statements used by the pipeline. Keeping each as one constant string means the
+# sqlite3 statement cache always hits and executemany reuses a single prepared statement.
+# RETURNING (SQLite 3.35+) binds the new parent id to the statement's own result row.
+INSERT_PARENT_SQL = "INSERT INTO parent_questions (question_text, options, answer, subject, chapter, source_file, source_page) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id"
+INSERT_VARIANT_SQL = "INSERT INTO variant_questions (parent_id, question_text, options, correct_answer, explanation, difficulty, diagram_latex) VALUES (?, ?, ?, ?, ?, ?, ?)"
+INSERT_LOG_SQL = "INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)"
+
+@contextmanager
+def write_transaction(conn):
+    """Runs the enclosed statements in one BEGIN IMMEDIATE ... COMMIT, rolling back on error."""
+    # IMMEDIATE takes the write lock up front, so the transaction can't fail half-way with SQLITE_BUSY.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        # SQLite may already have rolled back (SQLITE_FULL, IOERR, ...); a second ROLLBACK would
+        # raise and mask the original error.
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def create_indexes(cursor):
+    """Creates the indexes used by the hot lookups. Safe to run on an existing database."""
+    # validation_status drives the dashboard counts and '/validate'; with parent_id appended the
+    # export's status filter + join is answered from the index alone.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vq_status_parent ON variant_questions(validation_status, parent_id);")
+    # parent_id is the join/lookup key from a variant back to its parent question.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_variant_parent ON variant_questions(parent_id);")
+    # Matches the export's ORDER BY subject, chapter.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pq_subject_chapter ON parent_questions(subject, chapter, id);")
+    # Planner statistics: this runs on every dashboard start, so a full ANALYZE only happens while
+    # no statistics exist yet; after that PRAGMA optimize re-analyzes only where SQLite sees a need.
+    stats_table = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+    has_stats = stats_table and cursor.execute("SELECT 1 FROM sqlite_stat1 LIMIT 1").fetchone()
+    cursor.execute("PRAGMA optimize;" if has_stats else "ANALYZE;")
+
 def setup_database():
     if os.path.exists(DB_FILE):
         os.remove(DB_FILE)
         print("Existing database removed.", flush=True)
+    # A WAL database leaves -wal/-shm side files; stale ones must not be replayed into the new DB.
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(DB_FILE + suffix):
+            os.remove(DB_FILE + suffix)
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -62,6 +120,8 @@ def setup_database():
         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(source_file, page_num)
     );''')
+    cursor.execute(LLM_CACHE_SCHEMA)
+    create_indexes(cursor)
     
     # --- THE DEFINITIVE FIX ---
     # Set the journal mode to WAL permanently on the database file.
@@ -77,8 +137,9 @@ def setup_database():
 # === CORE AUGMENTATION PIPELINE (No changes needed below this line) ===========
 # ==============================================================================
 
-def create_parser_prompt(page_text):
-    return f"""
+# Static parts of the two prompts, built once at import. Only the page text / parent question
+# varies between calls, and keeping the instructions byte-identical lets them be cached upstream.
+PARSER_PROMPT_PREFIX = """
     You are a text analysis expert. Your task is to carefully read the following text from a textbook page and identify every distinct question.
 
     INSTRUCTIONS:
@@ -89,33 +150,33 @@ def create_parser_prompt(page_text):
 
     OUTPUT FORMAT:
     Your entire response MUST be a single, valid JSON formatted list `[]`. Each object in the list represents ONE question and must follow this exact schema:
-    {{
+    {
       "question_text": "The full text of the question.",
       "options": ["Option A", "Option B", "Option C", "Option D"],
       "answer": "The correct answer letter or text, if found."
-    }}
+    }
     If no questions are found, return an empty list `[]`.
 
     TEXT TO PARSE:
     ---
-    {page_text}
+    """
+PARSER_PROMPT_SUFFIX = """
     ---
     """
-
-def create_augment_prompt(parent_question, parent_options):
-    options_str = "\n".join([f"- {opt}" for opt in parent_options]) if parent_options else "N/A"
-    return f"""
+AUGMENT_PROMPT_PREFIX = """
     You are an expert curriculum developer specializing in creating high-quality assessment items for American high school AP exams.
     Your task is to take a single "parent" question and generate 6 new, distinct "variant" questions based on it.
 
     PARENT QUESTION:
-    Text: "{parent_question}"
-    Options: {options_str}
+    Text: \""""
+AUGMENT_PROMPT_MIDDLE = """"
+    Options: """
+AUGMENT_PROMPT_SUFFIX = """
 
     INSTRUCTIONS:
     1.  **Generate 6 Variants:** Create two 'easy', two 'medium', and two 'hard' variants.
     2.  **CRITICAL FORMATTING RULES:**
-        *   **Math and Symbols:** All chemical formulas, nuclides (e.g., `$^{{238}}_{{92}}$U`), variables (e.g., `$A_x$`), and equations MUST be enclosed in proper LaTeX math delimiters (`$...$`).
+        *   **Math and Symbols:** All chemical formulas, nuclides (e.g., `$^{238}_{92}$U`), variables (e.g., `$A_x$`), and equations MUST be enclosed in proper LaTeX math delimiters (`$...$`).
         *   **Options:** Do NOT include labels like 'A)', 'B)', etc., in the option text itself. The list should contain only the raw text for each option.
     3.  **Vary the Problem:**
         *   Easy: Simplify numbers, reduce steps, or ask for a direct definition.
@@ -123,18 +184,183 @@ def create_augment_prompt(parent_question, parent_options):
         *   Hard: Introduce a complex scenario, require multiple steps, or combine concepts.
     4.  **Diagrams:**
         *   If a diagram is needed, you MUST generate valid LaTeX code using the `tikzpicture` environment.
-        *   The code MUST be self-contained within a `\\begin{{tikzpicture}}...\\end{{tikzpicture}}` block.
+        *   The code MUST be self-contained within a `\\begin{tikzpicture}...\\end{tikzpicture}` block.
         *   If no diagram is needed, the `diagram_latex` field MUST be an empty string `""`.
     5.  **Output Format:** Your response MUST be a single, valid JSON formatted list `[]` containing exactly 6 objects with this schema:
-    {{
+    {
       "difficulty": "easy",
       "question_text": "The new variant question text with LaTeX math.",
       "options": ["New Option A text", "New Option B text", "New Option C text", "New Option D text"],
       "correct_answer": "The letter of the correct option (e.g., 'A').",
       "explanation": "A clear, step-by-step explanation with LaTeX math.",
-      "diagram_latex": "\\begin{{tikzpicture}}...\\end{{tikzpicture}}"
-    }}
+      "diagram_latex": "\\begin{tikzpicture}...\\end{tikzpicture}"
+    }
+    """
+
+# Tokens that matter when locating a JSON array: whole string literals (skipped over in C, so
+# brackets inside them are ignored) and the bracket characters themselves.
+JSON_ARRAY_TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|[\[\]]')
+
+def extract_json_array(text):
+    """Returns the first balanced top-level JSON array in an LLM response.
+
+    Surrounding prose and markdown fences are ignored. Raises ValueError if no complete
+    array is present (e.g. a truncated response).
+    """
+    start = text.find('[')
+    if start == -1:
+        raise ValueError("No JSON array found in response.")
+    depth = 0
+    for match in JSON_ARRAY_TOKEN_RE.finditer(text, start):
+        token = match.group()
+        if token == '[':
+            depth += 1
+        elif token == ']':
+            depth -= 1
+            if depth == 0:
+                return text[start:match.end()]
+    raise ValueError("Unbalanced JSON array in response.")
+
+# Repeat detection: the same MCQ reprinted on another page (differing only in spacing)
+# normalises to the same key. Case, numbers and options are kept, so distinct questions never collide.
+QUESTION_SPACE_RE = re.compile(r'\s+')
+
+def normalize_question(question_text, options):
+    """Collapses whitespace in a question and its options to build a repeat key."""
+    text = str(question_text or '').strip()
+    if not text:
+        return ''
+    return QUESTION_SPACE_RE.sub(' ', "\n".join((text, json_dumps(options))))
+
+def is_repeat_question(seen_questions, seen_lock, key):
+    """True if a question with this key already got variants earlier in this run."""
+    if not key:
+        return False
+    with seen_lock:
+        return key in seen_questions
+
+def record_question(seen_questions, seen_lock, key):
+    """Marks a question as augmented. Only called once variants were obtained, so a failed
+    attempt leaves later reprints free to retry."""
+    if key:
+        with seen_lock:
+            seen_questions.add(key)
+
+def create_parser_prompt(page_text):
+    return "".join((PARSER_PROMPT_PREFIX, page_text, PARSER_PROMPT_SUFFIX))
+
+def create_augment_prompt(parent_question, parent_options):
+    options_str = "\n".join([f"- {opt}" for opt in parent_options]) if parent_options else "N/A"
+    return "".join((AUGMENT_PROMPT_PREFIX, str(parent_question), AUGMENT_PROMPT_MIDDLE, options_str, AUGMENT_PROMPT_SUFFIX))
+
+def extract_page_text(pdf, page_num):
+    """Returns the plain text of a 1-based page using pdfium's native text extraction."""
+    # Close the page and text page straight away so native memory stays flat over long chapters.
+    with closing(pdf[page_num - 1]) as page, closing(page.get_textpage()) as textpage:
+        page_text = textpage.get_text_range()
+    # pdfium separates lines with CRLF; normalise so prompts match the old pdfplumber text.
+    return page_text.replace('\r\n', '\n')
+
+def augment_page(page_num, page_text, seen_questions, seen_lock):
+    """Runs the parser and augmentation prompts for one page on a worker thread.
+
+    Returns (status, page_results), where page_results is a list of (parent_question, variants).
+    Parents that repeat one already augmented in this run (same question and options,
+    see `normalize_question`) are kept without variants. No database access happens here;
+    the caller writes the results.
     """
+    response_text = gemini_manager.get_response(create_parser_prompt(page_text))
+    if not response_text:
+        return 'failed_parsing', []
+
+    try:
+        parent_questions = orjson.loads(extract_json_array(response_text))
+    except ValueError:  # also covers orjson.JSONDecodeError
+        return 'failed_json_decode', []
+
+    if not parent_questions:
+        return 'no_questions_found', []
+
+    # parent_questions.question_text is NOT NULL: a parent without it would fail its INSERT and take
+    # the whole page down with it, after an augment call had already been paid for. Drop it here.
+    valid_questions = [q for q in parent_questions if isinstance(q, dict) and q.get('question_text')]
+    if len(valid_questions) < len(parent_questions):
+        print(f"    --> Page {page_num}: ignoring {len(parent_questions) - len(valid_questions)} parsed entries without question text.", flush=True)
+    parent_questions = valid_questions
+    if not parent_questions:
+        return 'no_questions_found', []
+
+    print(f"    --> Found {len(parent_questions)} parent questions on page {page_num}.", flush=True)
+
+    page_results = []
+    for parent_q_idx, parent_q in enumerate(parent_questions):
+        print(f"      -> Page {page_num}: augmenting parent question {parent_q_idx + 1}/{len(parent_questions)}...", flush=True)
+
+        variants = []
+        question_key = normalize_question(parent_q.get('question_text'), parent_q.get('options'))
+        if is_repeat_question(seen_questions, seen_lock, question_key):
+            print(f"        --> Page {page_num}: parent question {parent_q_idx + 1} repeats an earlier question. Skipping augmentation.", flush=True)
+            page_results.append((parent_q, variants))
+            continue
+
+        variant_response = gemini_manager.get_response(create_augment_prompt(parent_q.get('question_text'), parent_q.get('options')))
+        
+        if not variant_response:
+            print(f"        --> Page {page_num}: FAILED to generate variants for parent question {parent_q_idx + 1}.", flush=True)
+        else:
+            try:
+                variants = orjson.loads(extract_json_array(variant_response))
+            except ValueError:  # also covers orjson.JSONDecodeError
+                print(f"        --> Page {page_num}: FAILED to decode JSON from augment response for parent question {parent_q_idx + 1}.", flush=True)
+
+        if variants:
+            record_question(seen_questions, seen_lock, question_key)
+        page_results.append((parent_q, variants))
+
+    return 'success', page_results
+
+def save_page_results(conn, subject, chapter, pdf_file, page_num, status, page_results):
+    """Writes a page's parents, variants and processed_log row in one transaction."""
+    # Serialise everything before taking the write lock so the transaction only runs the inserts.
+    prepared = []
+    for parent_q, variants in page_results:
+        parent_row = (parent_q.get('question_text'), json_dumps(parent_q.get('options')), parent_q.get('answer'), subject, chapter, pdf_file, page_num)
+        variant_rows = [(variant.get('question_text'), json_dumps(variant.get('options')), variant.get('correct_answer'), variant.get('explanation'), variant.get('difficulty'), variant.get('diagram_latex')) for variant in variants]
+        prepared.append((parent_row, variant_rows))
+
+    cursor = conn.cursor()
+    with write_transaction(conn):
+        for parent_row, variant_rows in prepared:
+            parent_id = cursor.execute(INSERT_PARENT_SQL, parent_row).fetchone()[0]
+            if variant_rows:
+                cursor.executemany(INSERT_VARIANT_SQL, [(parent_id,) + row for row in variant_rows])
+                print(f"        --> Saved {len(variant_rows)} variants for parent ID {parent_id}.", flush=True)
+        cursor.execute(INSERT_LOG_SQL, (pdf_file, page_num, status))
+
+# Sentinel posted to the writer queue once every page has been queued.
+WRITER_STOP = object()
+
+def result_writer(write_queue, subject, chapter, pdf_file):
+    """Drains (page_num, status, page_results) items into SQLite on its own connection.
+
+    Runs on a separate thread so the main thread can keep extracting pages and collecting
+    results while the API workers sit out their cooldowns.
+    """
+    conn = get_db_connection()
+    try:
+        while True:
+            item = write_queue.get()
+            if item is WRITER_STOP:
+                break
+            page_num, status, page_results = item
+            try:
+                save_page_results(conn, subject, chapter, pdf_file, page_num, status, page_results)
+            except Exception as e:
+                # Malformed results or a DB error must not kill the writer and silently drop every
+                # later page; this page is left out of processed_log, so it is retried on the next run.
+                print(f"  Could not save results for page {page_num}: {e}", flush=True)
+    finally:
+        conn.close()
 
 def run_augmentation_for_chapter(subject, pdf_file, chapter, start_page, end_page):
     conn = get_db_connection()
@@ -142,81 +368,50 @@ def run_augmentation_for_chapter(subject, pdf_file, chapter, start_page, end_pag
     filepath = os.path.join(RAW_PDF_DIR, pdf_file)
 
     print(f"\n--- Starting augmentation for: {subject} - {chapter} ({pdf_file}) ---", flush=True)
+
+    # One worker per API key; the shared manager hands each call the key that has rested longest.
+    num_workers = len(gemini_manager.keys)
+    # Normalised question+options keys already sent for augmentation in this run, shared by the workers.
+    seen_questions = set()
+    seen_lock = threading.Lock()
+
+    write_queue = queue.Queue()
+    writer = threading.Thread(target=result_writer, args=(write_queue, subject, chapter, pdf_file), daemon=True)
+    writer.start()
     
     try:
-        with pdfplumber.open(filepath) as pdf:
+        with closing(pdfium.PdfDocument(filepath)) as pdf, ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # One query for every page already logged for this file, instead of one per page.
+            processed_pages = {row[0] for row in cursor.execute("SELECT page_num FROM processed_log WHERE source_file = ?", (pdf_file,))}
+            pages_to_process = []
             for page_num in range(start_page, end_page + 1):
-                cursor.execute("SELECT id FROM processed_log WHERE source_file = ? AND page_num = ?", (pdf_file, page_num))
-                if cursor.fetchone():
+                if page_num in processed_pages:
                     print(f"  Page {page_num} already processed. Skipping.", flush=True)
                     continue
-                
-                print(f"  Processing Page {page_num}/{end_page}...", flush=True)
-                page_text = pdf.pages[page_num - 1].extract_text()
-                if not page_text or len(page_text.strip()) < 50:
-                    cursor.execute("INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)", (pdf_file, page_num, 'skipped_no_text'))
-                    conn.commit()
-                    continue
-
-                response_text = gemini_manager.get_response(create_parser_prompt(page_text))
-                if not response_text:
-                    cursor.execute("INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)", (pdf_file, page_num, 'failed_parsing'))
-                    conn.commit()
-                    continue
-
-                try:
-                    start = response_text.find('[')
-                    end = response_text.rfind(']')
-                    parent_questions = json.loads(response_text[start:end+1])
-                except (json.JSONDecodeError, IndexError):
-                    cursor.execute("INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)", (pdf_file, page_num, 'failed_json_decode'))
-                    conn.commit()
-                    continue
-                
-                if not parent_questions:
-                    cursor.execute("INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)", (pdf_file, page_num, 'no_questions_found'))
-                    conn.commit()
-                    continue
+                pages_to_process.append(page_num)
 
-                print(f"    --> Found {len(parent_questions)} parent questions on page {page_num}.", flush=True)
-
-                for parent_q_idx, parent_q in enumerate(parent_questions):
-                    print(f"      -> Augmenting parent question {parent_q_idx + 1}/{len(parent_questions)}...", flush=True)
-                    
-                    cursor.execute(
-                        "INSERT INTO parent_questions (question_text, options, answer, subject, chapter, source_file, source_page) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (parent_q.get('question_text'), json.dumps(parent_q.get('options')), parent_q.get('answer'), subject, chapter, pdf_file, page_num)
-                    )
-                    parent_id = cursor.lastrowid
-
-                    variant_response = gemini_manager.get_response(create_augment_prompt(parent_q.get('question_text'), parent_q.get('options')))
-                    
-                    if not variant_response:
-                        print(f"        --> FAILED to generate variants for parent ID {parent_id}.", flush=True)
+            # Pages are handled in batches: text is extracted here (pdfium is not thread-safe),
+            # the API work runs on the pool, and results are queued for the writer in page order.
+            for batch_start in range(0, len(pages_to_process), PAGE_BATCH_SIZE):
+                futures = []
+                for page_num in pages_to_process[batch_start:batch_start + PAGE_BATCH_SIZE]:
+                    print(f"  Processing Page {page_num}/{end_page}...", flush=True)
+                    page_text = extract_page_text(pdf, page_num)
+                    if not page_text or len(page_text.strip()) < 50:
+                        write_queue.put((page_num, 'skipped_no_text', []))
                         continue
+                    futures.append((page_num, executor.submit(augment_page, page_num, page_text, seen_questions, seen_lock)))
 
-                    try:
-                        start_v = variant_response.find('[')
-                        end_v = variant_response.rfind(']')
-                        variants = json.loads(variant_response[start_v:end_v+1])
-                        
-                        for variant in variants:
-                            cursor.execute(
-                                "INSERT INTO variant_questions (parent_id, question_text, options, correct_answer, explanation, difficulty, diagram_latex) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                (parent_id, variant.get('question_text'), json.dumps(variant.get('options')), variant.get('correct_answer'), variant.get('explanation'), variant.get('difficulty'), variant.get('diagram_latex'))
-                            )
-                        print(f"        --> Saved {len(variants)} variants for parent ID {parent_id}.", flush=True)
-                    except (json.JSONDecodeError, IndexError):
-                        print(f"        --> FAILED to decode JSON from augment response for parent ID {parent_id}.", flush=True)
-                    
-                    conn.commit()
-
-                cursor.execute("INSERT INTO processed_log (source_file, page_num, status) VALUES (?, ?, ?)", (pdf_file, page_num, 'success'))
-                conn.commit()
+                for page_num, future in futures:
+                    status, page_results = future.result()
+                    write_queue.put((page_num, status, page_results))
 
     except Exception as e:
         print(f"A critical error occurred during augmentation: {e}", flush=True)
     finally:
+        # Let the writer flush everything still queued before reporting completion.
+        write_queue.put(WRITER_STOP)
+        writer.join()
         print("\n--- Augmentation for chapter complete. ---", flush=True)
         conn.close()
 
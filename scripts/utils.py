@@ -1,84 +1,164 @@
 import os
 import time
-import google.generativeai as genai
+import hashlib
+import sqlite3
+import threading
+from google import genai
 from dotenv import load_dotenv
 
+# --- Configuration ---
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILE = os.path.join(ROOT_DIR, 'data', 'question_bank.db')
+
+# Responses are cached per prompt so reruns/resumes don't pay the cooldown or the API cost again.
+LLM_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    prompt_hash TEXT PRIMARY KEY, response TEXT NOT NULL, created_at INTEGER
+);"""
+
+# Read .env once at import; every GeminiAPI built without explicit keys reuses this list.
+load_dotenv()
+GEMINI_API_KEYS = [key for key in (os.getenv(f"GEMINI_API_KEY_{i}") for i in range(1, 5)) if key]
+
+# Using the model you requested
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
 class GeminiAPI:
-    """Manages multiple API keys, rotates them, and handles retries with a global cooldown."""
-    def __init__(self):
-        load_dotenv()
-        self.keys = [os.getenv(f"GEMINI_API_KEY_{i}") for i in range(1, 5) if os.getenv(f"GEMINI_API_KEY_{i}")]
+    """Manages multiple API keys with a per-key cooldown; safe to share between worker threads."""
+    def __init__(self, keys=None, cache_db=DB_FILE, cooldown_period=13):
+        self.keys = list(GEMINI_API_KEYS if keys is None else keys)
         if not self.keys:
             raise ValueError("No GEMINI_API_KEY found in .env file. Please check your configuration.")
-        self.current_key_index = 0
         
         # --- RATE LIMITING FIX ---
         # The cooldown period in seconds. 13s provides a small safety buffer for the 5 RPM limit (60s / 5 = 12s).
-        self.cooldown_period = 13 
-        # Track the time of the last API call.
-        self.last_call_time = 0
+        self.cooldown_period = cooldown_period
+        # Time of the last API call, tracked per key since each key has its own rate limit.
+        self.last_call_time = {key: 0 for key in self.keys}
+        
+        # One client per key, so concurrent calls never share process-global key state.
+        self.clients = {key: genai.Client(api_key=key) for key in self.keys}
+        # Keys currently held by a worker; a key serves one call at a time to honour its cooldown.
+        self._busy_keys = set()
+        self._key_available = threading.Condition()
+        
+        # SQLite file holding the llm_cache table; None disables the response cache.
+        self.cache_db = cache_db
         
         print(f"Loaded {len(self.keys)} Gemini API keys. Cooldown set to {self.cooldown_period} seconds.", flush=True)
 
+    def _acquire_key(self, exclude=()):
+        """Blocks until a key outside `exclude` is free, then claims the least recently used one."""
+        with self._key_available:
+            while True:
+                free_keys = [key for key in self.keys if key not in self._busy_keys and key not in exclude]
+                if free_keys:
+                    key = min(free_keys, key=self.last_call_time.__getitem__)
+                    self._busy_keys.add(key)
+                    return key
+                self._key_available.wait()
+
+    def _release_key(self, key):
+        with self._key_available:
+            self._busy_keys.discard(key)
+            self._key_available.notify_all()
+
+    def _cache_connection(self):
+        conn = sqlite3.connect(self.cache_db, timeout=15)
+        conn.execute(LLM_CACHE_SCHEMA)
+        return conn
+
+    def get_cached_response(self, prompt_hash):
+        """Returns the cached response for a prompt hash, or None on a miss or any cache error."""
+        if not self.cache_db:
+            return None
+        try:
+            conn = self._cache_connection()
+            row = conn.execute("SELECT response FROM llm_cache WHERE prompt_hash = ?", (prompt_hash,)).fetchone()
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"    --> Response cache unavailable: {e}", flush=True)
+            return None
+        return row[0] if row else None
+
+    def store_cached_response(self, prompt_hash, response_text):
+        if not self.cache_db:
+            return
+        try:
+            conn = self._cache_connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (prompt_hash, response, created_at) VALUES (?, ?, ?)",
+                    (prompt_hash, response_text, int(time.time()))
+                )
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"    --> Could not cache response: {e}", flush=True)
+
     def get_response(self, prompt_text):
-        # --- RATE LIMITING FIX: ENFORCE COOLDOWN ---
-        # This block runs BEFORE every API call, guaranteeing the rate limit is respected.
-        time_since_last_call = time.time() - self.last_call_time
-        if time_since_last_call < self.cooldown_period:
-            wait_time = self.cooldown_period - time_since_last_call
-            print(f"    --> Cooldown active. Waiting for {wait_time:.2f} seconds...", flush=True)
-            time.sleep(wait_time)
+        # A cache hit skips both the cooldown and the API call.
+        prompt_hash = hashlib.sha256(prompt_text.encode('utf-8')).hexdigest()
+        cached = self.get_cached_response(prompt_hash)
+        if cached is not None:
+            print("    --> Using cached response for this prompt.", flush=True)
+            return cached
 
         max_retries_per_key = 3
         initial_wait_time = 5
 
-        # Loop through keys for resiliency
+        # Try each key at most once, always taking the free key that has rested the longest.
+        tried_keys = set()
         for _ in range(len(self.keys)):
-            key = self.keys[self.current_key_index]
-            key_index_for_log = self.current_key_index
-            
-            # Update last call time immediately before the attempt
-            self.last_call_time = time.time()
-            
-            wait_time = initial_wait_time
-            for retry_attempt in range(max_retries_per_key):
-                try:
-                    print(f"    --> Attempting API call with Key Index {key_index_for_log} (Attempt {retry_attempt + 1}/{max_retries_per_key})...", flush=True)
-                    genai.configure(api_key=key)
-                    safety_settings = [
-                        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                    ]
-                    # Using the model you requested
-                    model = genai.GenerativeModel('gemini-2.5-flash', safety_settings=safety_settings)
-                    
-                    response = model.generate_content(prompt_text)
-                    
-                    # After a successful call, rotate to the next key for the *next* request
-                    self.current_key_index = (self.current_key_index + 1) % len(self.keys)
-                    
-                    if not response.parts:
-                        print(f"    --> Response blocked by safety settings. Rotating key.", flush=True)
-                        break 
-                    
-                    return response.text
-
-                except Exception as e:
-                    error_str = str(e)
-                    print(f"    --> API Error with Key Index {key_index_for_log}: {error_str[:90]}...", flush=True)
-                    if "429" in error_str:
-                        print(f"    --> Rate limit error hit. Waiting for {wait_time}s before retrying.", flush=True)
-                        time.sleep(wait_time)
-                        wait_time *= 2 # Exponential backoff
-                        # Also update the last call time after a failed attempt's wait period
-                        self.last_call_time = time.time()
-                    else:
-                        print(f"    --> Non-retriable error. Rotating to next key.", flush=True)
-                        # Rotate key on non-429 error
-                        self.current_key_index = (self.current_key_index + 1) % len(self.keys)
-                        break # Break from retries for this key
+            key = self._acquire_key(exclude=tried_keys)
+            tried_keys.add(key)
+            key_index_for_log = self.keys.index(key)
+            try:
+                # --- RATE LIMITING FIX: ENFORCE COOLDOWN ---
+                # This block runs BEFORE every API call, guaranteeing the key's rate limit is respected.
+                time_since_last_call = time.time() - self.last_call_time[key]
+                if time_since_last_call < self.cooldown_period:
+                    wait_time = self.cooldown_period - time_since_last_call
+                    print(f"    --> Cooldown active for Key Index {key_index_for_log}. Waiting for {wait_time:.2f} seconds...", flush=True)
+                    time.sleep(wait_time)
+
+                # Update last call time immediately before the attempt
+                self.last_call_time[key] = time.time()
+
+                wait_time = initial_wait_time
+                for retry_attempt in range(max_retries_per_key):
+                    try:
+                        print(f"    --> Attempting API call with Key Index {key_index_for_log} (Attempt {retry_attempt + 1}/{max_retries_per_key})...", flush=True)
+                        response = self.clients[key].models.generate_content(
+                            model=GEMINI_MODEL_NAME, contents=prompt_text, config={"safety_settings": SAFETY_SETTINGS}
+                        )
+
+                        if not response.text:
+                            print(f"    --> Response blocked by safety settings. Rotating key.", flush=True)
+                            break
+
+                        self.store_cached_response(prompt_hash, response.text)
+                        return response.text
+
+                    except Exception as e:
+                        error_str = str(e)
+                        print(f"    --> API Error with Key Index {key_index_for_log}: {error_str[:90]}...", flush=True)
+                        if "429" in error_str:
+                            print(f"    --> Rate limit error hit. Waiting for {wait_time}s before retrying.", flush=True)
+                            time.sleep(wait_time)
+                            wait_time *= 2 # Exponential backoff
+                            # Also update the last call time after a failed attempt's wait period
+                            self.last_call_time[key] = time.time()
+                        else:
+                            print(f"    --> Non-retriable error. Rotating to next key.", flush=True)
+                            break # Break from retries for this key
+            finally:
+                self._release_key(key)
         
         print("    --> All API keys failed for this request. Skipping.", flush=True)
         return None